@@ -1,70 +1,171 @@
+import io
+import selectors
 import socket
 import threading
 import time
-import csv
 import numpy as np
-from collections import defaultdict
 from datetime import datetime
 
+# Binary frame sent by clients when binary_frames=True (24 bytes, little-endian)
+FRAME_DTYPE = np.dtype([('ts', '<f8'), ('h', '<f4'), ('k', '<f4'),
+                        ('phi', '<f4'), ('del_t', '<f4')])
+
+class ClientConnection:
+    """Per-client socket state used by the receive loop"""
+    def __init__(self, sock, client_id):
+        self.sock = sock
+        self.client_id = client_id
+        # Fixed receive buffer; data[:filled] holds bytes not yet consumed,
+        # including a partial line/frame carried between reads
+        self.data = bytearray(1 << 16)
+        self.view = memoryview(self.data)
+        self.filled = 0
+        self.last_data_time = time.time()
+
+
+class SampleBuffer:
+    """Preallocated del_t ring buffer for one client and one recording"""
+    def __init__(self, size):
+        self.values = np.empty(size, np.float64)
+        self.count = 0  # total samples stored, including overwritten ones
+        self.closed = False  # set by the recorder; later stores are dropped
+    
+    def append(self, del_t):
+        if self.closed:
+            return
+        self.values[self.count % self.values.size] = del_t  # overwrite oldest when full
+        self.count += 1
+    
+    def extend(self, del_t_values):
+        if self.closed:
+            return
+        size = self.values.size
+        n = self.count
+        if del_t_values.size > size:
+            # Only the newest size values survive the wrap
+            n += del_t_values.size - size
+            del_t_values = del_t_values[-size:]
+        idx = (n + np.arange(del_t_values.size)) % size
+        self.values[idx] = del_t_values
+        self.count = n + del_t_values.size
+    
+    def close(self):
+        """Stop accepting samples; returns (count, kept values in time order)"""
+        self.closed = True
+        count = self.count
+        size = self.values.size
+        if count > size:
+            # Oldest kept sample sits right after the last write
+            return count, np.roll(self.values, -(count % size))
+        return count, self.values[:count].copy()
+
+
 class CalibrationServer:
-    def __init__(self, host='192.168.12.171', port=6060, num_clients=3):
+    def __init__(self, host='192.168.12.171', port=6060, num_clients=3,
+                 sample_rate=1000.0, binary_frames=False):
         self.host = host
         self.port = port
         self.num_clients = num_clients
+        self.sample_rate = sample_rate  # expected samples/s per client
+        self.binary_frames = binary_frames  # FRAME_DTYPE records instead of CSV
         
-        self.clients = []
-        self.client_data = defaultdict(list)  # {client_id: [data_lines]}
+        self.clients = []  # ClientConnection per connected client
+        self.selector = selectors.DefaultSelector()
+        # {client_id: {generation: SampleBuffer}}; samples are stored only
+        # while a buffer exists for the current generation
+        self.buffers = {i + 1: {} for i in range(num_clients)}
+        self.generation = 0
         self.client_status = {}  # {client_id: 'connected'/'disconnected'}
         self.clients_ready = threading.Event()
-        self.recording = False
-        self.lock = threading.Lock()
+        self.lock = threading.Lock()  # guards client_status only
         
         self.position_index = 0  # Which calibration position we're on
         
-    def handle_client(self, client_socket, client_address, client_id):
-        """Handle individual client connection"""
-        print(f"[Client {client_id}] Connected from {client_address}")
+    def handle_client(self, conn):
+        """Process newly readable data from one client connection"""
+        n = conn.sock.recv_into(conn.view[conn.filled:])
+        if not n:
+            return False
         
-        with self.lock:
-            self.client_status[client_id] = 'connected'
+        conn.last_data_time = time.time()
+        conn.filled += n
         
-        try:
-            buffer = ""
-            last_data_time = time.time()
+        # None when not recording
+        samples = self.buffers[conn.client_id].get(self.generation)
+        if self.binary_frames:
+            consumed = self.store_frames(samples, conn.data, conn.filled)
+        else:
+            consumed = self.store_lines(samples, conn.data, conn.filled)
+        
+        if consumed:
+            # Move the partial line/frame to the front
+            remaining = conn.filled - consumed
+            conn.data[:remaining] = conn.data[consumed:conn.filled]
+            conn.filled = remaining
+        elif conn.filled == len(conn.data):
+            print(f"[Client {conn.client_id}] Oversized message, discarding buffer")
+            conn.filled = 0
+        return True
+    
+    def store_lines(self, samples, data, filled):
+        """Parse del_t (6th field) from complete lines; returns bytes consumed"""
+        if samples is None:
+            # Not recording: skip complete lines without parsing them
+            return data.rfind(b'\n', 0, filled) + 1
+        
+        start = 0
+        while True:
+            end = data.find(b'\n', start, filled)
+            if end < 0:
+                break
             
-            while True:
-                client_socket.settimeout(5.0)  # 5 second timeout
-                
+            try:
+                samples.append(float(data[start:end].split(b',', 6)[5]))
+            except (ValueError, IndexError):
+                pass
+            start = end + 1
+        return start
+    
+    def store_frames(self, samples, data, filled):
+        """Copy del_t from complete binary frames; returns bytes consumed"""
+        count = filled // FRAME_DTYPE.itemsize
+        if count and samples is not None:
+            frames = np.frombuffer(data, FRAME_DTYPE, count=count)
+            samples.extend(frames['del_t'])
+        return count * FRAME_DTYPE.itemsize
+    
+    def disconnect_client(self, conn):
+        """Unregister and close one client connection"""
+        self.selector.unregister(conn.sock)
+        with self.lock:
+            self.client_status[conn.client_id] = 'disconnected'
+        conn.sock.close()
+        print(f"[Client {conn.client_id}] Disconnected")
+    
+    def receive_loop(self):
+        """Receive data from all clients on a single thread"""
+        # Start liveness tracking now, not at accept time
+        for conn in self.clients:
+            conn.last_data_time = time.time()
+        
+        while self.selector.get_map():
+            for key, _ in self.selector.select(timeout=1.0):
+                conn = key.data
                 try:
-                    data = client_socket.recv(1024).decode('utf-8')
-                except socket.timeout:
-                    # Check if client is still alive
-                    if time.time() - last_data_time > 10:
-                        print(f"[Client {client_id}] Timeout - no data received")
-                        break
-                    continue
-                
-                if not data:
-                    break
-                
-                last_data_time = time.time()
-                buffer += data
-                
-                # Process complete lines
-                while '\n' in buffer:
-                    line, buffer = buffer.split('\n', 1)
-                    
-                    if self.recording:
-                        with self.lock:
-                            self.client_data[client_id].append(line)
-                            
-        except Exception as e:
-            print(f"[Client {client_id}] Error: {e}")
-        finally:
-            with self.lock:
-                self.client_status[client_id] = 'disconnected'
-            client_socket.close()
-            print(f"[Client {client_id}] Disconnected")
+                    alive = self.handle_client(conn)
+                except Exception as e:
+                    print(f"[Client {conn.client_id}] Error: {e}")
+                    alive = False
+                if not alive:
+                    self.disconnect_client(conn)
+            
+            # Check if clients are still alive
+            now = time.time()
+            for key in list(self.selector.get_map().values()):
+                conn = key.data
+                if now - conn.last_data_time > 10:
+                    print(f"[Client {conn.client_id}] Timeout - no data received")
+                    self.disconnect_client(conn)
     
     def wait_for_clients(self):
         """Wait for all clients to connect"""
@@ -81,17 +182,29 @@ class CalibrationServer:
                 client_socket, client_address = server_socket.accept()
                 client_id = i + 1
                 
-                # Start thread to handle this client
-                client_thread = threading.Thread(
-                    target=self.handle_client,
-                    args=(client_socket, client_address, client_id)
-                )
-                client_thread.daemon = True
-                client_thread.start()
+                # Tune for a continuous stream of small messages
+                client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                try:
+                    # Linux only; ACK immediately instead of delaying
+                    client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+                except (AttributeError, OSError):
+                    pass
+                client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+                print(f"[Client {client_id}] Connected from {client_address}")
+                
+                conn = ClientConnection(client_socket, client_id)
+                self.selector.register(client_socket, selectors.EVENT_READ, data=conn)
+                with self.lock:
+                    self.client_status[client_id] = 'connected'
                 
-                self.clients.append((client_socket, client_thread))
+                self.clients.append(conn)
                 print(f"✓ Client {client_id} connected ({i+1}/{self.num_clients})")
             
+            # Start the single receive thread for all clients
+            receive_thread = threading.Thread(target=self.receive_loop)
+            receive_thread.daemon = True
+            receive_thread.start()
+            
             print(f"\n✓ All {self.num_clients} clients connected!")
             self.clients_ready.set()
             
@@ -122,9 +235,11 @@ class CalibrationServer:
             if response.lower() != 'y':
                 return False
         
-        # Clear previous data
-        with self.lock:
-            self.client_data.clear()
+        # Preallocate buffers for this point (20% headroom over expected rate)
+        generation = self.generation + 1
+        max_samples = max(1, int(self.sample_rate * duration * 1.2))
+        for client_id in self.buffers:
+            self.buffers[client_id][generation] = SampleBuffer(max_samples)
         
         print(f"\n{'='*60}")
         print(f"Recording calibration point {self.position_index + 1}")
@@ -139,57 +254,51 @@ class CalibrationServer:
             time.sleep(1)
         print("Recording!")
         
-        # Start recording
-        self.recording = True
+        # Start recording: samples now go to this generation's buffers
+        self.generation = generation
         
-        # Show progress
+        # Show progress once per second, sleeping in between so the
+        # receive thread runs unobstructed
         start_time = time.time()
-        while time.time() - start_time < duration:
-            elapsed = time.time() - start_time
-            remaining = duration - elapsed
+        remaining = duration
+        while remaining > 0:
             print(f"\rRecording... {remaining:.1f}s remaining", end='', flush=True)
-            time.sleep(0.1)
+            time.sleep(min(1.0, remaining))
+            remaining = duration - (time.time() - start_time)
         
-        self.recording = False
+        # Stop recording: the next generation has no buffers, so late
+        # samples are dropped instead of leaking into this point
+        self.generation = generation + 1
+        # Close the buffers too: a read that started before the bump may
+        # still hold one, so analyze a snapshot rather than the live array
+        recorded = {client_id: self.buffers[client_id].pop(generation).close()
+                    for client_id in self.buffers}
         print("\n\nRecording complete!")
         
         # Analyze and save data for each client
-        with self.lock:
-            all_saved = True
-            for client_id in range(1, self.num_clients + 1):
-                if client_id not in self.client_data:
-                    print(f"  ⚠ Client {client_id}: No data received")
-                    all_saved = False
-                    continue
-                
-                data_lines = self.client_data[client_id]
-                print(f"  Client {client_id}: {len(data_lines)} samples recorded")
-                
-                # Parse and validate data
-                del_t_values = []
-                for line in data_lines:
-                    try:
-                        parts = line.strip().split(',')
-                        if len(parts) >= 6:
-                            del_t = float(parts[5])
-                            print(del_t);
-                            del_t_values.append(del_t)
-                    except (ValueError, IndexError):
-                        continue
-                
-                if del_t_values:
-                    del_t_array = np.array(del_t_values)
-                    print(f"    Valid samples: {len(del_t_values)}")
-                    print(f"    del_t mean: {np.mean(del_t_array):.6f}s")
-                    print(f"    del_t std:  {np.std(del_t_array):.6f}s")
-                    
-                    # Save to CSV file
-                    filename = f'data_{client_id}_{self.position_index + 1}.csv'
-                    self.save_to_csv(filename, x_source, y_source, data_lines)
-                    print(f"    ✓ Saved to {filename}")
-                else:
-                    print(f"    ⚠ No valid data to save")
-                    all_saved = False
+        all_saved = True
+        for client_id in range(1, self.num_clients + 1):
+            n, del_t_array = recorded[client_id]
+            if not n:
+                print(f"  ⚠ Client {client_id}: No valid data received")
+                all_saved = False
+                continue
+            
+            print(f"  Client {client_id}: {n} samples recorded")
+            
+            if n > del_t_array.size:
+                print(f"    ⚠ Buffer full, kept the last {del_t_array.size} samples "
+                      f"(raise sample_rate)")
+            
+            print(f"    del_t mean: {np.mean(del_t_array):.6f}s")
+            print(f"    del_t std:  {np.std(del_t_array):.6f}s")
+            print(f"    del_t range: {del_t_array.min():.6f}s .. "
+                  f"{del_t_array.max():.6f}s")
+            
+            # Save to CSV file
+            filename = f'data_{client_id}_{self.position_index + 1}.csv'
+            self.save_to_csv(filename, x_source, y_source, del_t_array)
+            print(f"    ✓ Saved to {filename}")
         
         if all_saved:
             self.position_index += 1
@@ -198,29 +307,25 @@ class CalibrationServer:
             print("\n⚠ Some clients had no valid data. Point not counted.")
             return False
     
-    def save_to_csv(self, filename, x_source, y_source, data_lines):
+    def save_to_csv(self, filename, x_source, y_source, del_t_array):
         """
         Save calibration data to CSV in the format expected by optimizer:
         - First row: x_source, y_source
         - Remaining rows: del_t values (one per row)
         
-        Input data format from client: timestamp,h,k,phi,del_t
+        del_t_array: del_t values recorded for this point
         """
-        with open(filename, 'w', newline='') as f:
-            writer = csv.writer(f)
-            
-            # First row: source position
-            writer.writerow([x_source, y_source])
-            
-            # Extract del_t from each line and write
-            for line in data_lines:
-                try:
-                    parts = line.strip().split(',')
-                    if len(parts) >= 6:
-                        del_t = float(parts[5])  # del_t is the 5th field (index 4)
-                        writer.writerow([del_t])
-                except (ValueError, IndexError) as e:
-                    continue
+        # Format the whole file in memory, then write it in one call
+        buf = io.BytesIO()
+        
+        # First row: source position
+        buf.write(f"{x_source},{y_source}\n".encode())
+        
+        # Remaining rows: del_t values
+        np.savetxt(buf, del_t_array, fmt='%.9g')
+        
+        with open(filename, 'wb') as f:
+            f.write(buf.getvalue())
     
     def print_summary(self):
         """Print summary of calibration session"""
@@ -314,15 +419,21 @@ def main():
     HOST = '192.168.12.171'  # Server IP - change this to your server's IP
     PORT = 6060              # Server port
     NUM_CLIENTS = 3          # Number of microphone clients
+    SAMPLE_RATE = 1000.0     # Expected samples/s per client (sizes buffers)
+    BINARY_FRAMES = False    # True if clients send FRAME_DTYPE records, not CSV
     
     print("\nConfiguration:")
     print(f"  Host: {HOST}")
     print(f"  Port: {PORT}")
     print(f"  Expected clients: {NUM_CLIENTS}")
+    print(f"  Expected sample rate: {SAMPLE_RATE} Hz")
+    print(f"  Protocol: {'binary frames' if BINARY_FRAMES else 'CSV lines'}")
     print(f"\nMake sure your Rust clients connect to {HOST}:{PORT}\n")
     
     # Create and run server
-    server = CalibrationServer(host=HOST, port=PORT, num_clients=NUM_CLIENTS)
+    server = CalibrationServer(host=HOST, port=PORT, num_clients=NUM_CLIENTS,
+                               sample_rate=SAMPLE_RATE,
+                               binary_frames=BINARY_FRAMES)
     server.run()
 
 
@@ -1,14 +1,36 @@
 import numpy as np
-import pandas as pd
-from scipy.optimize import minimize, differential_evolution
+from scipy.optimize import minimize, least_squares
+import matplotlib
+matplotlib.use('Agg')  # batch mode: save figures, no GUI event loop
 import matplotlib.pyplot as plt
+import contextlib
 import csv
+import io
+from concurrent.futures import ProcessPoolExecutor
 
 
 # Constants
 SPEED_OF_SOUND = 343.0  # m/s
 MIC_DISTANCES = [0.055, 0.063, 0.063]  # distance between mics in each array
 
+# Search region for the mic pose: x, y within +-5 m of the origin. theta
+# is periodic, so it is left unbounded (any bound can trap the fit at its
+# edge); results are normalized to [-pi, pi] afterwards.
+POSE_BOUNDS = [(-5.0, 5.0), (-5.0, 5.0), (None, None)]
+
+def on_pose_bound(mic_pose, tol=1e-6):
+    """True if x or y of a fitted pose is pinned to the POSE_BOUNDS box"""
+    for value, (lo, hi) in zip(mic_pose, POSE_BOUNDS):
+        if (lo is not None and value <= lo + tol) or (hi is not None and value >= hi - tol):
+            return True
+    return False
+
+# Extra least-squares starting points spread over the search region
+SPREAD_STARTS = [(x, y, theta)
+                 for x in (-3.0, 0.0, 3.0)
+                 for y in (-3.0, 0.0, 3.0)
+                 for theta in (-np.pi / 2, 0.0, np.pi / 2, np.pi)]
+
 
 def save_to_csv(filename, h, k, theta, d):
     with open(filename, 'w', newline='') as f:
@@ -28,8 +50,8 @@ def time_delay_to_angle(delta_t, mic_index):
 def angle_difference(angle1, angle2):
     """Compute the smallest difference between two angles (handles wraparound)"""
     diff = angle1 - angle2
-    # Normalize to [-pi, pi]
-    return np.arctan2(np.sin(diff), np.cos(diff))
+    # Normalize to [-pi, pi] without transcendental calls
+    return diff - 2 * np.pi * np.round(diff / (2 * np.pi))
 
 def compute_expected_angle(mic_pose, source_pos):
     """
@@ -51,33 +73,62 @@ def compute_expected_angle(mic_pose, source_pos):
     
     return angle_local
 
+def angle_residuals(mic_pose, measured_angles, source_positions):
+    """Per-point angle errors, for least_squares"""
+    x_mic, y_mic, theta_mic = mic_pose
+    expected_angles = np.arctan2(source_positions[:, 1] - y_mic,
+                                 source_positions[:, 0] - x_mic) - theta_mic
+    return angle_difference(measured_angles, expected_angles)
+
+def angle_residuals_jacobian(mic_pose, measured_angles, source_positions):
+    """Analytic (N, 3) Jacobian of angle_residuals"""
+    x_mic, y_mic, _ = mic_pose
+    dx = source_positions[:, 0] - x_mic
+    dy = source_positions[:, 1] - y_mic
+    r2 = np.maximum(dx**2 + dy**2, 1e-12)  # mic on a source point
+    return np.column_stack((-dy / r2, dx / r2, np.ones_like(r2)))
+
 def objective_function(mic_pose, measured_angles, source_positions):
     """
     Objective function: sum of squared angle errors
     
     mic_pose: [x_mic, y_mic, theta_mic]
-    measured_angles: list of measured angles from array
-    source_positions: list of [x, y] source positions
+    measured_angles: array (N,) of measured angles from array
+    source_positions: array (N, 2) of [x, y] source positions
+    """
+    errors = angle_residuals(mic_pose, measured_angles, source_positions)
+    return np.dot(errors, errors)
+
+def objective_and_gradient(mic_pose, measured_angles, source_positions):
     """
-    total_error = 0.0
+    objective_function and its analytic gradient w.r.t. [x_mic, y_mic, theta_mic]
     
-    for measured_angle, source_pos in zip(measured_angles, source_positions):
-        expected_angle = compute_expected_angle(mic_pose, source_pos)
-        error = angle_difference(measured_angle, expected_angle)
-        total_error += error**2
+    Returns (total_error, gradient) for minimize(..., jac=True)
+    """
+    x_mic, y_mic, theta_mic = mic_pose
+    dx = source_positions[:, 0] - x_mic
+    dy = source_positions[:, 1] - y_mic
+    r2 = np.maximum(dx**2 + dy**2, 1e-12)  # mic on a source point
+    errors = angle_difference(measured_angles, np.arctan2(dy, dx) - theta_mic)
     
-    return total_error
+    # d(expected)/dx = dy/r^2, d/dy = -dx/r^2, d/dtheta = -1
+    gradient = np.array([
+        -2.0 * np.dot(errors, dy / r2),
+        2.0 * np.dot(errors, dx / r2),
+        2.0 * np.sum(errors),
+    ])
+    return np.dot(errors, errors), gradient
 
 def load_and_process_data(mic_index, position_index):
     """Load data and compute mean angle for one position"""
     filename = f'data_{mic_index+1}_{position_index+1}.csv'
-    df = pd.read_csv(filename, header=None)
-    
-    # First row contains source position
-    x_src, y_src = df.iloc[0].values
-    
-    # Remaining rows contain time delays
-    time_delays = df.iloc[1:, 0].values
+    with open(filename, 'rb') as f:
+        # First row contains source position
+        x_src, y_src = map(float, f.readline().split(b','))
+        
+        # Remaining rows contain time delays
+        time_delays = np.loadtxt(f, delimiter=',', usecols=(0,),
+                                 dtype=np.float64, ndmin=1)
     mean_time_delay = np.mean(time_delays)
     
     # Convert to angle
@@ -85,75 +136,127 @@ def load_and_process_data(mic_index, position_index):
     
     return (x_src, y_src), angle
 
-def calibrate_microphone_array(mic_index, num_positions, method='nelder-mead', 
-                               initial_guess=None, use_global=False):
+def calibrate_microphone_array(mic_index, num_positions, method='L-BFGS-B', 
+                               initial_guess=None, use_global=False,
+                               calibration_data=None):
     """
     Calibrate microphone array position and orientation
     
     mic_index: which microphone array (0, 1, or 2)
     num_positions: number of calibration positions
-    method: optimization method ('nelder-mead', 'powell', 'bfgs')
-    initial_guess: [x, y, theta] initial guess (if None, uses [0, 0, 0])
-    use_global: if True, use global optimization (slower but more robust)
+    method: optimization method ('L-BFGS-B', 'bfgs', 'nelder-mead', 'powell')
+    initial_guess: [x, y, theta] initial guess (if None, uses [5, 5, 5.3])
+    use_global: if True, use a multi-start least-squares fit from
+        initial_guess and SPREAD_STARTS, keeping the best (more robust)
+    calibration_data: (source_positions, measured_angles) from a previous
+        call, to skip reloading the CSV files
+    
+    Returns: (mic_pose, error, source_positions, measured_angles)
     """
     # Load all calibration data
-    source_positions = []
-    measured_angles = []
-    
-    for pos_idx in range(num_positions):
-        source_pos, angle = load_and_process_data(mic_index, pos_idx)
-        source_positions.append(source_pos)
-        measured_angles.append(angle)
+    if calibration_data is not None:
+        source_positions, measured_angles = calibration_data
+    else:
+        source_positions = []
+        measured_angles = []
+        
+        for pos_idx in range(num_positions):
+            source_pos, angle = load_and_process_data(mic_index, pos_idx)
+            source_positions.append(source_pos)
+            measured_angles.append(angle)
     
     print(f"\nCalibrating Microphone Array {mic_index + 1}")
     print(f"Number of calibration points: {num_positions}")
     print(f"Source positions: {source_positions}")
     print(f"Measured angles (deg): {[np.degrees(a) for a in measured_angles]}")
     
+    # Arrays for the vectorized objective, built once per calibration
+    source_array = np.asarray(source_positions, dtype=float)
+    angle_array = np.asarray(measured_angles, dtype=float)
+    
     # Initial guess
     if initial_guess is None:
         initial_guess = [5.0, 5.0, 5.3]
     
     if use_global:
-        # Global optimization - more robust but slower
-        # Define bounds: assume mics are within a reasonable area
-        bounds = [(-5, 5), (-5, 5), (-np.pi, np.pi)]
-        result = differential_evolution(
-            objective_function,
-            bounds,
-            args=(measured_angles, source_positions),
-            seed=42,
-            atol=1e-6,
-            tol=1e-6
-        )
+        # Bounded nonlinear least squares on the angle residuals from several
+        # starts; each converges in a handful of iterations
+        lower = np.array([-np.inf if lo is None else lo for lo, _ in POSE_BOUNDS])
+        upper = np.array([np.inf if hi is None else hi for _, hi in POSE_BOUNDS])
+        starts = [np.clip(initial_guess, lower, upper)] + SPREAD_STARTS
+        result = None
+        for x0 in starts:
+            candidate = least_squares(
+                angle_residuals,
+                x0,
+                jac=angle_residuals_jacobian,
+                args=(angle_array, source_array),
+                bounds=(lower, upper),
+                method='trf',
+                xtol=1e-10,
+                ftol=1e-10
+            )
+            if result is None or candidate.cost < result.cost:
+                result = candidate
+        # Normalize orientation to [-pi, pi]
+        result.x[2] = angle_difference(result.x[2], 0.0)
+        error = 2.0 * result.cost  # cost is half the sum of squares
     else:
         # Local optimization
-        result = minimize(
-            objective_function,
-            initial_guess,
-            args=(measured_angles, source_positions),
-            method=method,
-            options={'maxiter': 10000, 'xatol': 1e-8, 'fatol': 1e-8}
-        )
+        if method.lower() in ('nelder-mead', 'powell'):
+            # Derivative-free methods
+            result = minimize(
+                objective_function,
+                initial_guess,
+                args=(angle_array, source_array),
+                method=method,
+                bounds=POSE_BOUNDS,
+                options={'maxiter': 10000, 'xatol': 1e-8, 'fatol': 1e-8}
+            )
+        else:
+            # Gradient-based methods use the analytic gradient
+            result = minimize(
+                objective_and_gradient,
+                initial_guess,
+                args=(angle_array, source_array),
+                method=method,
+                jac=True,
+                bounds=POSE_BOUNDS if method.lower() == 'l-bfgs-b' else None,
+                options={'maxiter': 10000}
+            )
+            if not result.success:
+                print(f"\n⚠ {method} failed ({result.message}), "
+                      f"falling back to nelder-mead...")
+                result = minimize(
+                    objective_function,
+                    result.x,
+                    args=(angle_array, source_array),
+                    method='nelder-mead',
+                    bounds=POSE_BOUNDS,
+                    options={'maxiter': 10000, 'xatol': 1e-8, 'fatol': 1e-8}
+                )
+        error = result.fun
+        # Normalize orientation to [-pi, pi]
+        result.x[2] = angle_difference(result.x[2], 0.0)
     
     if result.success:
         x_mic, y_mic, theta_mic = result.x
         print(f"\n✓ Optimization successful!")
         print(f"Microphone position: ({x_mic:.4f}, {y_mic:.4f})")
         print(f"Microphone orientation: {np.degrees(theta_mic):.2f}°")
-        print(f"Final error (sum of squared angle errors): {result.fun:.6f}")
-        print(f"RMS angle error: {np.sqrt(result.fun / num_positions):.4f} rad "
-              f"({np.degrees(np.sqrt(result.fun / num_positions)):.2f}°)")
+        print(f"Final error (sum of squared angle errors): {error:.6f}")
+        print(f"RMS angle error: {np.sqrt(error / num_positions):.4f} rad "
+              f"({np.degrees(np.sqrt(error / num_positions)):.2f}°)")
 
         save_to_csv(f'sensor{mic_index+1}.csv', x_mic, y_mic, theta_mic, MIC_DISTANCES[mic_index])
 
     else:
         print(f"\n✗ Optimization failed: {result.message}")
     
-    return result.x, result.fun
+    return result.x, error, source_positions, measured_angles
 
-def visualize_calibration(mic_pose, source_positions, measured_angles):
-    """Visualize the calibration result"""
+def visualize_calibration(mic_pose, source_positions, measured_angles, mic_index):
+    """Visualize the calibration result (saved as calibration_result_N.png)"""
     x_mic, y_mic, theta_mic = mic_pose
     
     fig, ax = plt.subplots(figsize=(10, 10))
@@ -187,49 +290,79 @@ def visualize_calibration(mic_pose, source_positions, measured_angles):
     
     ax.set_xlabel('X (m)')
     ax.set_ylabel('Y (m)')
-    ax.set_title('Microphone Array Calibration')
+    ax.set_title(f'Microphone Array {mic_index + 1} Calibration')
     ax.legend()
     ax.grid(True, alpha=0.3)
     ax.axis('equal')
     
     plt.tight_layout()
-    plt.savefig('calibration_result.png', dpi=150)
-    plt.show()
-
-# Main execution
-if __name__ == "__main__":
-     # Which microphone array (0, 1, or 2)
-    num_positions = 7  # Number of calibration positions
-
-
+    plt.savefig(f'calibration_result_{mic_index+1}.png', dpi=150)
+    plt.close(fig)
 
-    for mic_index in range(0, 3):
+def calibrate_one(mic_index, num_positions):
+    """
+    Full calibration for one microphone array (run in a worker process)
+    
+    Console output is captured and returned so the parent can print each
+    mic's report in order instead of interleaving workers.
+    
+    Returns: (mic_pose, error, source_positions, measured_angles,
+              used_fallback, report)
+    """
+    report = io.StringIO()
+    with contextlib.redirect_stdout(report):
         # Try with local optimization first
-        result, error = calibrate_microphone_array(
+        result, error, source_positions, measured_angles = calibrate_microphone_array(
             mic_index=mic_index,
             num_positions=num_positions,
-            method='nelder-mead',
+            method='L-BFGS-B',
             initial_guess=[0.0, 0.0, 0.0],
             use_global=False
         )
         
-        # If error is too high, try global optimization
+        # If error is too high, or the bounded fit stopped against the
+        # x/y box instead of converging, try the least-squares fit
         rms_error_deg = np.degrees(np.sqrt(error / num_positions))
-        if rms_error_deg > 10:  # If RMS error > 10 degrees
-            print("\n⚠ Error too high, trying global optimization...")
-            result, error = calibrate_microphone_array(
+        pinned = on_pose_bound(result)
+        used_fallback = rms_error_deg > 10 or pinned  # If RMS error > 10 degrees
+        if used_fallback:
+            reason = "fit stopped at the search bound" if pinned else "error too high"
+            print(f"\n⚠ Array {mic_index + 1}: {reason}, "
+                  f"trying least-squares fit...")
+            result, error, source_positions, measured_angles = calibrate_microphone_array(
                 mic_index=mic_index,
                 num_positions=num_positions,
-                use_global=True
+                initial_guess=result,
+                use_global=True,
+                calibration_data=(source_positions, measured_angles)
             )
-            
-            # Load data for visualization
-        source_positions = []
-        measured_angles = []
-        for pos_idx in range(num_positions):
-            source_pos, angle = load_and_process_data(mic_index, pos_idx)
-            source_positions.append(source_pos)
-            measured_angles.append(angle)
-                
-                # Visualize
-        visualize_calibration(result, source_positions, measured_angles)
+    
+    return (result, error, source_positions, measured_angles,
+            used_fallback, report.getvalue())
+
+# Main execution
+if __name__ == "__main__":
+    num_positions = 7  # Number of calibration positions
+    num_mics = 3       # Microphone arrays (0, 1, 2) are calibrated in parallel
+    
+    with ProcessPoolExecutor(max_workers=num_mics) as executor:
+        results = list(executor.map(calibrate_one, range(num_mics),
+                                    [num_positions] * num_mics))
+    
+    # Print each array's report in mic_index order
+    for *_, report in results:
+        print(report, end='')
+    
+    print(f"\n{'='*60}")
+    print("CALIBRATION SUMMARY")
+    print(f"{'='*60}")
+    for mic_index, (result, error, _, _, used_fallback, _) in enumerate(results):
+        x_mic, y_mic, theta_mic = result
+        rms_error_deg = np.degrees(np.sqrt(error / num_positions))
+        method = 'least-squares fallback' if used_fallback else 'L-BFGS-B'
+        print(f"Array {mic_index + 1}: ({x_mic:.4f}, {y_mic:.4f}), "
+              f"{np.degrees(theta_mic):.2f}°, RMS {rms_error_deg:.2f}° [{method}]")
+    
+    for mic_index, (result, error, source_positions, measured_angles, _, _) in enumerate(results):
+        # Visualize
+        visualize_calibration(result, source_positions, measured_angles, mic_index)